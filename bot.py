@@ -7,12 +7,31 @@
 # - DM & Inline: send "0708 3255", "88807083255", or "+888 0708 3255" → returns OTP
 # - Buttons: Login/Refresh Session, Disconnect, Help; and per-number: Refresh/Open/Number/Send/Close
 # - All dynamic/system messages are HTML-escaped to avoid Telegram "Unsupported start tag" errors
+# - Playwright (and python-dotenv) are imported on demand to keep startup fast
 
-import os, re, time, asyncio, contextlib, traceback, html
+from __future__ import annotations
+
+import os, re, time, json, random, sqlite3, threading, asyncio, contextlib, functools, traceback, html
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional, Dict, Tuple
+from typing import Optional, Dict, List, Tuple, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from playwright.async_api import Browser, BrowserContext, Page
 
 # ================ Helpers & Env =================
+_NON_DIGIT = re.compile(r"\D")
+OTP_PATTERN = r"\b\d{5,6}\b"  # shared by the Python regex and the in-page JS poll
+_OTP_RE = re.compile(OTP_PATTERN)
+_find_otp = _OTP_RE.search
+_PHONE_RE = re.compile(r"\s*\+?[\d\s().-]{5,}")  # router-level prefilter for number messages
+_TOKEN_RE = re.compile(r"\d{6,}:[A-Za-z0-9_-]{30,}")
+_SCRIPT_STYLE_RE = re.compile(r"(?is)<(script|style)\b.*?</\1>")
+_TAG_RE = re.compile(r"(?s)<[^>]+>")
+_ZERO_WIDTH = str.maketrans("", "", "\ufeff\u200b")
+# deletes every Latin-1 non-digit (isdecimal, i.e. \d parity: superscripts go too)
+_KEEP_DIGITS = str.maketrans("", "", "".join(chr(c) for c in range(256) if not chr(c).isdecimal()))
+
 def safe_html(text: Optional[str]) -> str:
     """Escape any string so Telegram HTML parse_mode never breaks."""
     return html.escape(text or "")
@@ -20,20 +39,72 @@ def safe_html(text: Optional[str]) -> str:
 def _clean_token(val: Optional[str]) -> str:
     if not val:
         return ""
-    return val.replace("\ufeff", "").replace("\u200b", "").strip().strip('"').strip("'")
+    return val.translate(_ZERO_WIDTH).strip(" \t\r\n\"'")
 
 # Load .env if present
-try:
-    from dotenv import load_dotenv
-    load_dotenv()
-except Exception:
-    pass
+def _find_env_file() -> Optional[str]:
+    """Like dotenv.find_dotenv(): walk up from the script's directory, then try the cwd."""
+    d = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        path = os.path.join(d, ".env")
+        if os.path.isfile(path):
+            return path
+        parent = os.path.dirname(d)
+        if parent == d:
+            break
+        d = parent
+    return ".env" if os.path.isfile(".env") else None
+
+def _load_env_file(path: str):
+    try:
+        from dotenv import load_dotenv
+        load_dotenv(path)
+    except Exception:
+        pass
+
+_ENV_FILE = _find_env_file()
+if _ENV_FILE:
+    _load_env_file(_ENV_FILE)
 
 BOT_TOKEN = _clean_token(os.getenv("BOT_TOKEN"))
 FRAGMENT_STATE = "fragment_state.json"
+FRAGMENT_CACHE_DB = "fragment_cache.db"
 FRAGMENT_ORIGIN = "https://fragment.com"
+HTTP_USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+)
 
-if not BOT_TOKEN or not re.fullmatch(r"\d{6,}:[A-Za-z0-9_-]{30,}", BOT_TOKEN):
+# Headless fetch only reads page text: skip everything that doesn't carry it
+HEADLESS_ARGS = [
+    "--disable-gpu", "--disable-dev-shm-usage", "--no-sandbox", "--disable-extensions",
+    "--disable-background-networking", "--disable-sync", "--no-first-run", "--mute-audio",
+    "--disable-default-apps", "--disable-breakpad", "--disable-features=TranslateUI,BackForwardCache",
+    "--blink-settings=imagesEnabled=false",  # images never even reach the route filter
+]
+HEADLESS_CONTEXT_OPTS = dict(
+    viewport={"width": 800, "height": 600},
+    java_script_enabled=True,  # the code is rendered client-side
+    bypass_csp=True,
+    service_workers="block",  # keeps every request visible to the route filter
+)
+BLOCKED_RESOURCE_TYPES = {"image", "font", "media", "stylesheet", "texttrack", "manifest"}  # documents, scripts and XHR pass
+BLOCKED_URL_HINTS = ("google-analytics.com", "googletagmanager.com", "analytics")
+
+# CSS selector of the element holding the OTP on the /code page. When set (and present on the
+# page) only that element is read on each poll; otherwise every text node of <body> is scanned.
+OTP_SELECTOR = os.getenv("FRAGMENT_OTP_SELECTOR", "").strip()
+
+# Cache TTL adapts to fetch latency: ~2.5x the EMA, clamped to [ttl, CACHE_TTL_MAX]
+CACHE_TTL_MAX = 180.0  # Fragment login codes stay valid ~3 min
+CACHE_SOFT_CAP = 1000  # above this many entries new TTLs shrink linearly to 0 at 2x
+CACHE_TTL_JITTER = 0.2  # positive TTLs get up to +20% so entries don't all expire together
+NEG_TTL = 5.0  # "no code visible" is cached briefly too, ±NEG_TTL_JITTER seconds
+NEG_TTL_JITTER = 2.0
+CACHE_MAX_ENTRIES = 4096  # hard LRU cap on in-memory entries
+CACHE_GC_INTERVAL = 60.0  # seconds between sweeps of expired entries
+
+if not BOT_TOKEN or not _TOKEN_RE.fullmatch(BOT_TOKEN):
     raise SystemExit(
         "BOT_TOKEN missing/invalid.\n"
         "Put exactly this in ./.env (no quotes, no spaces):\n"
@@ -44,15 +115,18 @@ if not BOT_TOKEN or not re.fullmatch(r"\d{6,}:[A-Za-z0-9_-]{30,}", BOT_TOKEN):
 from aiogram import Bot, Dispatcher, Router, F
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import CommandStart, Command
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import (
     Message, CallbackQuery, InlineQuery,
     InlineQueryResultArticle, InputTextMessageContent
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-# ================ Playwright ====================
-from playwright.async_api import async_playwright, Browser, BrowserContext, TimeoutError as PWTimeout
+# ================ HTTP ==========================
+import aiohttp
+from yarl import URL
 
 # ================ Number utils ==================
 def normalize_to_888_digits(s: str) -> Optional[str]:
@@ -62,7 +136,12 @@ def normalize_to_888_digits(s: str) -> Optional[str]:
     """
     if not s:
         return None
-    digits = re.sub(r"\D", "", s)
+    if s.isdecimal():  # same char class as \d, unlike isdigit()
+        digits = s
+    else:
+        digits = s.translate(_KEEP_DIGITS)
+        if digits and not digits.isdecimal():  # other non-Latin-1 chars left: regex it
+            digits = _NON_DIGIT.sub("", s)
     if not digits:
         return None
     if not digits.startswith("888"):
@@ -76,8 +155,50 @@ def fragment_links(digits: str) -> Tuple[str, str]:
     base = f"{FRAGMENT_ORIGIN}/number/{digits}"
     return base, f"{base}/code"
 
+def visible_text(body: str) -> str:
+    """Strip scripts/styles/tags from an HTML (or JSON) body so the OTP regex only sees page text."""
+    body = _SCRIPT_STYLE_RE.sub(" ", body)
+    body = _TAG_RE.sub(" ", body)
+    return html.unescape(body)
+
+def _atomic_write_json(path: str, data) -> None:
+    """Write JSON to path via a temp file + os.replace so a crash never leaves it half-written."""
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+def _remove_file(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
+
+def load_state_cookies(state_file: str) -> List[Tuple[str, str, str, str]]:
+    """
+    Read cookies from a Playwright storage_state JSON as (name, value, domain, path), empty if missing.
+    Kept as a list: the same name (e.g. stel_ssid) appears on several domains.
+    """
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    except Exception:
+        return []
+    cookies = []
+    for c in state.get("cookies", []):
+        name, value, domain = c.get("name"), c.get("value"), (c.get("domain") or "").lstrip(".")
+        if not name or value is None or not domain:
+            continue
+        cookies.append((name, value, domain, c.get("path") or "/"))
+    return cookies
+
 # ================ Fragment Client ===============
-@dataclass
+async def _block_heavy_requests(route):
+    req = route.request
+    if req.resource_type in BLOCKED_RESOURCE_TYPES or any(h in req.url for h in BLOCKED_URL_HINTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+@dataclass(slots=True)
 class CodeResult:
     digits: str
     code: Optional[str]
@@ -90,166 +211,496 @@ class FragmentClient:
     Headful login flow to generate/update storage_state when needed.
     Only needs BOT_TOKEN; session is saved to FRAGMENT_STATE automatically.
     """
-    def __init__(self, state_file: str):
+    def __init__(self, state_file: str, cache_db: str = FRAGMENT_CACHE_DB, pool_size: int = 4):
         self.state_file = state_file
+        self.cache_db = cache_db
         self._pw = None
+        self._PWTimeout = None  # playwright's TimeoutError, bound by start()
         self._headless_browser: Optional[Browser] = None
         self._headless_ctx: Optional[BrowserContext] = None
+        self._headless_ready = asyncio.Event()  # set once browser + page pool are up
+        self._headless_launching = False
 
         self._login_browser: Optional[Browser] = None
         self._login_ctx: Optional[BrowserContext] = None
-
-        self._lock = asyncio.Lock()
-        self._cache: Dict[str, Tuple[float, Optional[str]]] = {}  # digits -> (ts, code)
+        self._login_stack: Optional[contextlib.AsyncExitStack] = None  # closes login ctx, then browser
+        self._login_requested: Optional[float] = None  # ts of the Login tap; window opens on Open
+        self._login_launching = False  # set before the first await so double taps can't launch twice
+
+        self._http_session: Optional[aiohttp.ClientSession] = None
+
+        self._pool_size = max(1, pool_size)
+        self._page_pool: asyncio.Queue[Page] = asyncio.Queue()  # warm tabs of _headless_ctx
+        # digits -> (ts, code, ttl), least recently used first
+        self._cache: OrderedDict[str, Tuple[float, Optional[str], float]] = OrderedDict()
+        self._gc_task: Optional[asyncio.Task] = None
+        self._db: Optional[sqlite3.Connection] = None  # on-disk copy of _cache, survives restarts
+        self._db_lock = threading.Lock()  # sqlite calls run in to_thread workers
+        self._fetch_ema: float = 0.0  # seconds, EMA of successful fetch latency
+        self._inflight: Dict[str, asyncio.Future[CodeResult]] = {}  # digits -> running fetch
 
     async def start(self):
         if self._pw:
             return
+        from playwright.async_api import async_playwright, TimeoutError as PWTimeout
+        self._PWTimeout = PWTimeout
         self._pw = await async_playwright().start()
+        self._ensure_http()
+        with contextlib.suppress(Exception):
+            await asyncio.to_thread(self._db_open)
+        self._gc_task = asyncio.create_task(self._gc_loop())
         # headless context launches lazily on first fetch
 
-    async def stop(self):
-        with contextlib.suppress(Exception):
-            if self._login_ctx: await self._login_ctx.close()
-        with contextlib.suppress(Exception):
-            if self._login_browser: await self._login_browser.close()
+    def _cache_put(self, digits: str, entry: Tuple[float, Optional[str], float]):
+        cache = self._cache
+        cache[digits] = entry
+        cache.move_to_end(digits)
+        while len(cache) > CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+    def _sweep_cache(self):
+        now = time.time()
+        expired = [d for d, (ts, _, ttl) in self._cache.items() if now - ts > ttl]
+        for d in expired:
+            del self._cache[d]
+
+    async def _gc_loop(self):
+        # drop expired entries (memory and disk) between misses so they don't pile up
+        while True:
+            await asyncio.sleep(CACHE_GC_INTERVAL)
+            self._sweep_cache()
+            with contextlib.suppress(Exception):
+                await asyncio.to_thread(self._db_purge_expired)
+
+    # ---------- Persistent cache (sqlite) ----------
+    def _db_open(self):
+        db = sqlite3.connect(self.cache_db, isolation_level=None, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS cache(digits TEXT PRIMARY KEY, ts REAL, code TEXT, ttl REAL)")
+        self._db = db
+        self._db_purge_expired()  # codes that expired while the bot was down
+
+    def _db_get(self, digits: str) -> Optional[Tuple[float, Optional[str], float]]:
+        if not self._db:
+            return None
+        with self._db_lock:
+            row = self._db.execute("SELECT ts, code, ttl FROM cache WHERE digits = ?", (digits,)).fetchone()
+        return tuple(row) if row else None
+
+    def _db_put(self, digits: str, entry: Tuple[float, Optional[str], float]):
+        if not self._db:
+            return
+        with self._db_lock:
+            self._db.execute("INSERT OR REPLACE INTO cache(digits, ts, code, ttl) VALUES (?, ?, ?, ?)", (digits, *entry))
+
+    def _db_purge_expired(self):
+        if not self._db:
+            return
+        with self._db_lock:
+            self._db.execute("DELETE FROM cache WHERE ts + ttl < ?", (time.time(),))
+
+    def _db_clear(self):
+        if not self._db:
+            return
+        with self._db_lock:
+            self._db.execute("DELETE FROM cache")
+
+    def _db_close(self):
+        if not self._db:
+            return
+        with self._db_lock:
+            self._db.close()
+        self._db = None
+
+    async def _clear_cache(self):
+        self._cache.clear()
         with contextlib.suppress(Exception):
-            if self._headless_ctx: await self._headless_ctx.close()
+            await asyncio.to_thread(self._db_clear)
+
+    def _ensure_http(self):
+        if self._http_session and not self._http_session.closed:
+            return
+        jar = aiohttp.CookieJar()
+        for name, value, domain, path in load_state_cookies(self.state_file):
+            # one call per cookie, scoped to its own domain, so same-named cookies don't clobber
+            # each other; a malformed one (CookieError) is skipped instead of failing start()
+            with contextlib.suppress(Exception):
+                jar.update_cookies({name: value}, response_url=URL(f"https://{domain}{path}"))
+        self._http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=60),
+            cookie_jar=jar,
+            headers={"User-Agent": HTTP_USER_AGENT},
+            timeout=aiohttp.ClientTimeout(total=10),
+        )
+
+    async def _reset_http(self):
         with contextlib.suppress(Exception):
-            if self._headless_browser: await self._headless_browser.close()
+            if self._http_session: await self._http_session.close()
+        self._http_session = None
+
+    async def stop(self):
+        if self._gc_task:
+            self._gc_task.cancel()
+            self._gc_task = None
+        await self._reset_http()
+        await self.cancel_headful_login()
+        await self._close_headless()
         with contextlib.suppress(Exception):
             if self._pw: await self._pw.stop()
         self._pw = None
+        with contextlib.suppress(Exception):
+            await asyncio.to_thread(self._db_close)
 
     async def _ensure_headless(self):
-        if self._headless_ctx:
+        if self._headless_ready.is_set():
             return
-        self._headless_browser = await self._pw.chromium.launch(headless=True)
+        if self._headless_launching:
+            # another caller is launching: wait for it instead of racing chromium.launch
+            await self._headless_ready.wait()
+            if not self._headless_ctx:
+                raise RuntimeError("headless browser failed to start")
+            return
+        self._headless_launching = True
+        try:
+            await self._ensure_browser()
+            await self._open_context()
+        except BaseException:
+            await self._close_context()
+            raise
+        finally:
+            self._headless_launching = False
+            # wake waiters either way; they check _headless_ctx to tell success from failure
+            self._headless_ready.set()
+            if not self._headless_ctx:
+                self._headless_ready.clear()
+
+    async def _ensure_browser(self):
+        # Chromium is launched once and outlives session changes; only the context is swapped
+        if self._headless_browser and self._headless_browser.is_connected():
+            return
+        self._headless_browser = await self._pw.chromium.launch(headless=True, args=HEADLESS_ARGS)
+
+    async def _open_context(self):
         if os.path.exists(self.state_file):
-            self._headless_ctx = await self._headless_browser.new_context(storage_state=self.state_file)
+            self._headless_ctx = await self._headless_browser.new_context(
+                storage_state=self.state_file, **HEADLESS_CONTEXT_OPTS
+            )
         else:
-            self._headless_ctx = await self._headless_browser.new_context()
+            self._headless_ctx = await self._headless_browser.new_context(**HEADLESS_CONTEXT_OPTS)
+        await self._headless_ctx.route("**/*", _block_heavy_requests)
+        for _ in range(self._pool_size):
+            await self._page_pool.put(await self._headless_ctx.new_page())
+
+    async def _reload_context(self):
+        """Swap in a context built from the current state file, keeping Chromium running."""
+        await self._close_context()
+        if self._headless_browser and self._headless_browser.is_connected():
+            with contextlib.suppress(Exception):
+                await self._ensure_headless()
+
+    async def warmup(self):
+        """Launch the headless browser ahead of the first fetch and warm DNS/TLS/cookies for Fragment."""
+        try:
+            await self.start()
+            await self._ensure_headless()
+            page = self._page_pool.get_nowait()
+        except Exception:
+            return  # first real fetch will retry and report the error
+        try:
+            await page.goto(FRAGMENT_ORIGIN, wait_until="domcontentloaded", timeout=20000)
+        except Exception:
+            pass
+        finally:
+            await self._release_page(page)
+
+    async def _close_context(self):
+        with contextlib.suppress(Exception):
+            if self._headless_ctx: await self._headless_ctx.close()
+        self._headless_ctx = None
+        self._headless_ready.clear()
+        self._page_pool = asyncio.Queue()  # pages died with the context
+
+    async def _close_headless(self):
+        await self._close_context()
+        with contextlib.suppress(Exception):
+            if self._headless_browser: await self._headless_browser.close()
+        self._headless_browser = None
+
+    async def _release_page(self, page: Page):
+        """Reset a pooled tab to about:blank and hand it back; replace it if it broke."""
+        if page.context is not self._headless_ctx:
+            return  # context was reset while this page was checked out
+        try:
+            await page.goto("about:blank")
+        except Exception:
+            with contextlib.suppress(Exception):
+                await page.close()
+            try:
+                page = await self._headless_ctx.new_page()
+            except Exception:
+                return
+        self._page_pool.put_nowait(page)
 
     # ---------- Login flow (headful) ----------
     async def start_headful_login(self) -> Tuple[bool, str]:
-        await self.start()
+        # metadata only: nothing is launched until the user taps Open, so Cancel costs nothing
         if self._login_browser:
             return True, "Headful window already open. Log in, then tap '✅ Save Session'."
+        self._login_requested = time.time()
+        return True, "Tap '🌐 Open Login Window' to open a browser, log in to Fragment, then tap '✅ Save Session'."
+
+    async def open_headful_login(self) -> Tuple[bool, str]:
+        if self._login_ctx:
+            return True, "Headful window already open. Log in, then tap '✅ Save Session'."
+        if self._login_launching:
+            return False, "The login window is already opening, give it a moment."
+        if self._login_requested is None:
+            return False, "No login in progress. Tap '🔑 Login/Refresh Session' first."
+        self._login_launching = True
+        try:
+            return await self._materialize_login()
+        finally:
+            self._login_launching = False
+
+    async def _materialize_login(self) -> Tuple[bool, str]:
+        requested = self._login_requested
+        stack = contextlib.AsyncExitStack()
         try:
-            self._login_browser = await self._pw.chromium.launch(headless=False)
-            self._login_ctx = await self._login_browser.new_context()
-            page = await self._login_ctx.new_page()
+            await self.start()
+            browser = await self._pw.chromium.launch(headless=False)
+            stack.push_async_callback(browser.close)
+            ctx = await browser.new_context()
+            stack.push_async_callback(ctx.close)
+            page = await ctx.new_page()
             await page.goto(FRAGMENT_ORIGIN, wait_until="domcontentloaded")
-            return True, "Headful window opened. Log in to Fragment, then come back and tap '✅ Save Session'."
         except Exception as e:
             with contextlib.suppress(Exception):
-                if self._login_ctx: await self._login_ctx.close()
-            with contextlib.suppress(Exception):
-                if self._login_browser: await self._login_browser.close()
-            self._login_ctx = None
-            self._login_browser = None
+                await stack.aclose()
             return False, f"Cannot open a visible browser here ({e}). Run once on a desktop to save session."
+        if self._login_requested != requested:
+            # cancelled (or restarted) while the browser was launching
+            with contextlib.suppress(Exception):
+                await stack.aclose()
+            return False, "Login flow cancelled."
+        self._login_stack, self._login_browser, self._login_ctx = stack, browser, ctx
+        return True, "Headful window opened. Log in to Fragment, then come back and tap '✅ Save Session'."
+
+    async def cancel_headful_login(self):
+        stack, self._login_stack = self._login_stack, None
+        if stack:
+            # every callback runs even if an earlier one raises
+            with contextlib.suppress(Exception):
+                await stack.aclose()
+        self._login_ctx = None
+        self._login_browser = None
+        self._login_requested = None
+
+    @property
+    def login_window_open(self) -> bool:
+        return self._login_ctx is not None
+
+    @property
+    def login_pending(self) -> bool:
+        return self._login_requested is not None or self._login_ctx is not None
 
     async def save_headful_session(self) -> Tuple[bool, str]:
         if not self._login_ctx:
-            return False, "No headful session in progress. Tap '🔑 Login/Refresh Session' first."
+            if self._login_requested is None:
+                return False, "No headful session in progress. Tap '🔑 Login/Refresh Session' first."
+            return False, "No login window open yet. Tap '🌐 Open Login Window' and log in first."
         try:
-            await self._login_ctx.storage_state(path=self.state_file)
-            with contextlib.suppress(Exception):
-                await self._login_ctx.close()
-            with contextlib.suppress(Exception):
-                await self._login_browser.close()
-            self._login_ctx = None
-            self._login_browser = None
-
-            # reset headless to reload new session on next fetch
-            with contextlib.suppress(Exception):
-                if self._headless_ctx: await self._headless_ctx.close()
-            with contextlib.suppress(Exception):
-                if self._headless_browser: await self._headless_browser.close()
-            self._headless_ctx = None
-            self._headless_browser = None
-            self._cache.clear()
+            state = await self._login_ctx.storage_state()
+            await asyncio.to_thread(_atomic_write_json, self.state_file, state)
+            await self.cancel_headful_login()
+
+            # new cookies: fresh context (same Chromium), HTTP jar and cache
+            await self._reset_http()
+            await self._clear_cache()
+            await self._reload_context()
             return True, f"Session saved to {self.state_file}. You can fetch codes now."
         except Exception as e:
             return False, f"Failed to save session: {e}"
 
     async def disconnect(self) -> Tuple[bool, str]:
+        await self.cancel_headful_login()
+        await self._close_context()
+        await self._reset_http()
+        await self._clear_cache()
         with contextlib.suppress(Exception):
-            if self._login_ctx: await self._login_ctx.close()
-        with contextlib.suppress(Exception):
-            if self._login_browser: await self._login_browser.close()
-        with contextlib.suppress(Exception):
-            if self._headless_ctx: await self._headless_ctx.close()
-        with contextlib.suppress(Exception):
-            if self._headless_browser: await self._headless_browser.close()
-        self._login_ctx = None
-        self._login_browser = None
-        self._headless_ctx = None
-        self._headless_browser = None
-        self._cache.clear()
-        with contextlib.suppress(Exception):
-            if os.path.exists(self.state_file):
-                os.remove(self.state_file)
+            await asyncio.to_thread(_remove_file, self.state_file)
+        await self._reload_context()
         return True, "Disconnected. Session file removed."
 
     # ---------- OTP fetch ----------
+    async def _http_get(self, url: str) -> Optional[str]:
+        # once Chromium is up, its APIRequestContext shares the live browser cookies
+        # (Fragment may have rotated them since the state file was written)
+        if self._headless_ready.is_set():
+            resp = await self._headless_ctx.request.get(url, timeout=10000)
+            try:
+                return await resp.text() if resp.status == 200 else None
+            finally:
+                await resp.dispose()
+        self._ensure_http()
+        async with self._http_session.get(url) as resp:
+            return await resp.text() if resp.status == 200 else None
+
+    async def _http_fetch_code(self, url: str) -> Optional[str]:
+        """Fast path: plain GET with the session cookies; None on HTTP error or no code in the body."""
+        try:
+            body = await self._http_get(url)
+        except Exception:
+            return None
+        if not body:
+            return None
+        m = _find_otp(visible_text(body))
+        return m.group(0) if m else None
+
+    async def _remember(self, digits: str, code: Optional[str], started: float, min_ttl: float):
+        now = time.time()
+        if code:
+            latency = now - started
+            self._fetch_ema = latency if not self._fetch_ema else 0.2 * latency + 0.8 * self._fetch_ema
+            ttl = min(CACHE_TTL_MAX, max(min_ttl, 2.5 * self._fetch_ema))
+            ttl += random.uniform(0, ttl * CACHE_TTL_JITTER)
+            n = len(self._cache)
+            if n > CACHE_SOFT_CAP:
+                ttl *= max(0.0, 1 - (n - CACHE_SOFT_CAP) / CACHE_SOFT_CAP)
+        else:
+            ttl = NEG_TTL + random.uniform(-NEG_TTL_JITTER, NEG_TTL_JITTER)
+        entry = (now, code, ttl)
+        self._cache_put(digits, entry)
+        if code:
+            with contextlib.suppress(Exception):
+                await asyncio.to_thread(self._db_put, digits, entry)
+
+    def peek_cache(self, digits: str) -> Optional[str]:
+        """Fresh cached code for digits, or None. Never fetches or starts a browser."""
+        hit = self._cache.get(digits)
+        if hit and hit[1] and (time.time() - hit[0] <= hit[2]):
+            return hit[1]
+        return None
+
     async def get_code(self, digits: str, ttl: int = 15, force_refresh: bool = False) -> CodeResult:
+        """
+        Cached/coalesced OTP fetch. Different numbers run in parallel (one pooled page each);
+        concurrent calls for the same number share a single in-flight fetch, so no per-number lock is needed.
+        """
         await self.start()
         url = fragment_links(digits)[1]  # /code page
 
+        cache, inflight = self._cache, self._inflight  # hot path: locals, not attribute lookups
+
         # cache
         now = time.time()
         if not force_refresh:
-            hit = self._cache.get(digits)
-            if hit and (now - hit[0] <= ttl) and hit[1]:
-                return CodeResult(digits, hit[1], url, "cached")
+            hit = cache.get(digits)
+            if hit:
+                cache.move_to_end(digits)
+            else:
+                with contextlib.suppress(Exception):
+                    hit = await asyncio.to_thread(self._db_get, digits)
+                if hit:
+                    self._cache_put(digits, hit)
+            if hit and (now - hit[0] <= hit[2]):
+                return CodeResult(digits, hit[1], url, "cached" if hit[1] else "cached_no_code")
+
+        # coalesce with a fetch already running for the same number
+        fut = inflight.get(digits)
+        if fut:
+            return await asyncio.shield(fut)
+        fut = asyncio.get_running_loop().create_future()
+        inflight[digits] = fut
+        try:
+            res = await self._fetch_code(digits, url, now, ttl)
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # mark retrieved; the caller gets it via raise
+            raise
+        else:
+            fut.set_result(res)
+        finally:
+            inflight.pop(digits, None)
+        return res
 
-        # ensure headless
+    async def _scan_page_text(self, page: Page) -> Optional[str]:
+        # miss-path fallback: a code split across several text nodes only shows up in innerText
+        try:
+            m = _find_otp(await page.evaluate("document.body.innerText"))
+        except Exception:
+            return None
+        return m.group(0) if m else None
+
+    async def _fetch_code(self, digits: str, url: str, now: float, ttl: float) -> CodeResult:
+        # HTTP fast path (no browser)
+        code = await self._http_fetch_code(url)
+        if code:
+            await self._remember(digits, code, now, ttl)
+            return CodeResult(digits, code, url, "ok")
+
+        # fall back to headless
         try:
             await self._ensure_headless()
         except Exception as e:
             return CodeResult(digits, None, url, f"browser_not_ready: {e}")
 
-        async with self._lock:
-            page = await self._headless_ctx.new_page()
+        try:
+            page = await asyncio.wait_for(self._page_pool.get(), timeout=20)
+        except asyncio.TimeoutError:
+            return CodeResult(digits, None, url, "browser_busy")
+
+        code = None
+        try:
             try:
                 await page.goto(url, wait_until="domcontentloaded", timeout=20000)
-            except PWTimeout:
-                with contextlib.suppress(Exception):
-                    await page.close()
+            except self._PWTimeout:
                 return CodeResult(digits, None, url, "timeout_opening_code_page")
 
-            code: Optional[str] = None
             try:
-                await page.wait_for_timeout(800)  # let JS populate
-                await page.wait_for_function(
-                    """() => {
-                        const rx = /\\b\\d{5,6}\\b/;
+                # returns the matched digits themselves, so no second round-trip for page text
+                handle = await page.wait_for_function(
+                    """({sel, pattern}) => {
+                        const rx = new RegExp(pattern);  // built once per poll, outside the node loop
+                        const els = sel ? document.querySelectorAll(sel) : [];
+                        if (els.length) {
+                            for (const el of els) {
+                                const m = (el.value || el.textContent || "").match(rx);
+                                if (m) return m[0];
+                            }
+                            return null;
+                        }
                         const walker = document.createTreeWalker(document.body, NodeFilter.SHOW_TEXT);
                         while (walker.nextNode()) {
-                            if (rx.test(walker.currentNode.textContent)) return true;
+                            const m = walker.currentNode.textContent.match(rx);
+                            if (m) return m[0];
                         }
-                        return false;
+                        return null;
                     }""",
-                    timeout=9000
+                    arg={"sel": OTP_SELECTOR, "pattern": OTP_PATTERN},
+                    polling=50,  # poll every 50 ms; returns as soon as JS has rendered the code
+                    timeout=5000
                 )
-                full_text = await page.evaluate("document.body.innerText")
-                m = re.search(r"\b\d{5,6}\b", full_text)
-                if m:
-                    code = m.group(0)
-            except PWTimeout:
-                code = None
+                code = await handle.json_value()
+            except self._PWTimeout:
+                code = await self._scan_page_text(page)
             except Exception:
                 code = None
-            finally:
-                with contextlib.suppress(Exception):
-                    await page.close()
+        finally:
+            await self._release_page(page)
 
-            self._cache[digits] = (time.time(), code)
-            return CodeResult(digits, code, url, "ok" if code else "no_code_visible")
+        await self._remember(digits, code, now, ttl)
+        return CodeResult(digits, code, url, "ok" if code else "no_code_visible")
 
 # ================ Keyboards =====================
+class CodeCB(CallbackData, prefix="code"):
+    """Code card buttons; packs to the same 'code:<action>:<digits>' strings as before."""
+    action: str
+    digits: str
+
 def main_menu_kb() -> InlineKeyboardBuilder:
     kb = InlineKeyboardBuilder()
     kb.button(text="🔑 Login/Refresh Session", callback_data="login:start")
@@ -258,59 +709,106 @@ def main_menu_kb() -> InlineKeyboardBuilder:
     kb.adjust(1, 1, 1)
     return kb
 
+def login_flow_kb(window_open: bool) -> InlineKeyboardBuilder:
+    kb = InlineKeyboardBuilder()
+    if window_open:
+        kb.button(text="✅ Save Session", callback_data="login:save")
+    else:
+        kb.button(text="🌐 Open Login Window", callback_data="login:open")
+    kb.button(text="❌ Cancel", callback_data="login:cancel")
+    kb.adjust(2)
+    return kb
+
 def code_card_kb(digits: str) -> InlineKeyboardBuilder:
     base, code_url = fragment_links(digits)
     kb = InlineKeyboardBuilder()
-    kb.button(text="🔁 Refresh", callback_data=f"code:refresh:{digits}")
+    kb.button(text="🔁 Refresh", callback_data=CodeCB(action="refresh", digits=digits).pack())
     kb.button(text="🔗 Open Code Page", url=code_url)
     kb.button(text="☎️ Number Page", url=base)
-    kb.button(text="📋 Send Digits", callback_data=f"code:digits:{digits}")
+    kb.button(text="📋 Send Digits", callback_data=CodeCB(action="digits", digits=digits).pack())
     kb.button(text="❌ Close", callback_data="ui:close")
     kb.adjust(2, 2, 1)
     return kb
 
+# markups only depend on their args, so build each one once
+MAIN_MENU_MARKUP = main_menu_kb().as_markup()
+
+def main_menu_markup():
+    return MAIN_MENU_MARKUP
+
+LOGIN_FLOW_MARKUPS = {open_: login_flow_kb(open_).as_markup() for open_ in (False, True)}
+
+def login_flow_markup(window_open: bool):
+    return LOGIN_FLOW_MARKUPS[window_open]
+
+@functools.lru_cache(maxsize=2048)
+def code_card_kb_markup(digits: str):
+    return code_card_kb(digits).as_markup()
+
 # ================ Router & Handlers =============
 router = Router()
 frag = FragmentClient(FRAGMENT_STATE)
+_bg_tasks: set = set()  # strong refs so fire-and-forget tasks aren't GC'd mid-run
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
+# last text shown on each code card, so Refresh can skip no-op edits
+SHOWN_CARDS_MAX = 1024
+_shown_cards: OrderedDict[Tuple[int, int], str] = OrderedDict()  # (chat_id, message_id) -> text
+
+def remember_card(msg: Optional[Message], text: str):
+    if not msg:
+        return
+    key = (msg.chat.id, msg.message_id)
+    _shown_cards[key] = text
+    _shown_cards.move_to_end(key)
+    while len(_shown_cards) > SHOWN_CARDS_MAX:
+        _shown_cards.popitem(last=False)
+
+START_TEXT = (
+    "👋 <b>+888 Code Fetcher</b>\n"
+    "Send me any +888 number in any format:\n"
+    "• <code>0708 3255</code>\n"
+    "• <code>88807083255</code>\n"
+    "• <code>+888 0708 3255</code>\n\n"
+    "I’ll open the Fragment <i>code page</i> and return the current login code.\n"
+    "Inline works too: type <code>@%s</code> <code>07083255</code>.\n\n"
+    "First time? Press <b>Login/Refresh Session</b> to log in to Fragment."
+)
+MENU_TEXT = "Main menu:"
+HELP_TEXT = (
+    "ℹ️ <b>How to use</b>\n"
+    "1) Tap <b>Login/Refresh Session</b>, then <b>Open Login Window</b> → A browser opens. Log in to Fragment and connect TON.\n"
+    "2) Come back and press <b>Save Session</b>.\n"
+    "3) Send any +888 number; I’ll fetch the current login code.\n\n"
+    "Buttons on each result: <b>Refresh</b>, <b>Open Code Page</b>, <b>Number Page</b>, <b>Send Digits</b>, <b>Close</b>."
+)
+CHECKENV_TEXT = (
+    "✅ Env loaded.\n"
+    f"Session file: <code>{safe_html(FRAGMENT_STATE)}</code>\n"
+    f"BOT_TOKEN: <code>{safe_html(BOT_TOKEN[:9] + '...' + BOT_TOKEN[-6:])}</code>"
+)
 
 @router.message(CommandStart())
 async def on_start(m: Message, bot: Bot):
     me = await bot.me()
-    await m.answer(
-        "👋 <b>+888 Code Fetcher</b>\n"
-        "Send me any +888 number in any format:\n"
-        "• <code>0708 3255</code>\n"
-        "• <code>88807083255</code>\n"
-        "• <code>+888 0708 3255</code>\n\n"
-        "I’ll open the Fragment <i>code page</i> and return the current login code.\n"
-        f"Inline works too: type <code>@{safe_html(me.username)}</code> <code>07083255</code>.\n\n"
-        "First time? Press <b>Login/Refresh Session</b> to log in to Fragment.",
-        reply_markup=main_menu_kb().as_markup()
-    )
+    await m.answer(START_TEXT % safe_html(me.username), reply_markup=main_menu_markup())
 
 @router.message(Command("menu"))
 async def on_menu(m: Message):
-    await m.answer("Main menu:", reply_markup=main_menu_kb().as_markup())
+    await m.answer(MENU_TEXT, reply_markup=main_menu_markup())
 
 @router.message(Command("checkenv"))
 async def check_env(m: Message):
-    masked = BOT_TOKEN[:9] + "..." + BOT_TOKEN[-6:]
-    await m.answer(
-        "✅ Env loaded.\n"
-        f"Session file: <code>{safe_html(FRAGMENT_STATE)}</code>\n"
-        f"BOT_TOKEN: <code>{safe_html(masked)}</code>"
-    )
+    await m.answer(CHECKENV_TEXT)
 
 @router.callback_query(F.data == "ui:help")
 async def ui_help(c: CallbackQuery):
-    await c.message.edit_text(
-        "ℹ️ <b>How to use</b>\n"
-        "1) Tap <b>Login/Refresh Session</b> → A browser opens. Log in to Fragment and connect TON.\n"
-        "2) Come back and press <b>Save Session</b> (button will appear).\n"
-        "3) Send any +888 number; I’ll fetch the current login code.\n\n"
-        "Buttons on each result: <b>Refresh</b>, <b>Open Code Page</b>, <b>Number Page</b>, <b>Send Digits</b>, <b>Close</b>.",
-        reply_markup=main_menu_kb().as_markup()
-    )
+    await c.message.edit_text(HELP_TEXT, reply_markup=main_menu_markup())
     await c.answer()
 
 @router.callback_query(F.data == "ui:close")
@@ -323,70 +821,72 @@ async def ui_close(c: CallbackQuery):
 @router.callback_query(F.data == "login:start")
 async def login_start(c: CallbackQuery):
     ok, msg = await frag.start_headful_login()
-    kb = InlineKeyboardBuilder()
-    if ok:
-        kb.button(text="✅ Save Session", callback_data="login:save")
-    kb.button(text="❌ Cancel", callback_data="login:cancel")
-    kb.adjust(2 if ok else 1)
     await c.message.answer(
         f"{'✅' if ok else '⚠️'} {safe_html(msg)}",
-        reply_markup=kb.as_markup()
+        reply_markup=login_flow_markup(frag.login_window_open)
+    )
+    await c.answer()
+
+@router.callback_query(F.data == "login:open")
+async def login_open(c: CallbackQuery):
+    ok, msg = await frag.open_headful_login()
+    markup = login_flow_markup(frag.login_window_open) if frag.login_pending else main_menu_markup()
+    await c.message.answer(
+        ("✅ " if ok else "⚠️ ") + safe_html(msg),
+        reply_markup=markup
     )
     await c.answer()
 
 @router.callback_query(F.data == "login:save")
 async def login_save(c: CallbackQuery):
     ok, msg = await frag.save_headful_session()
+    # keep Open/Save/Cancel around while a login is still in progress
+    markup = login_flow_markup(frag.login_window_open) if frag.login_pending else main_menu_markup()
     await c.message.answer(
         ("✅ " if ok else "⚠️ ") + safe_html(msg),
-        reply_markup=main_menu_kb().as_markup()
+        reply_markup=markup
     )
     await c.answer()
 
 @router.callback_query(F.data == "login:cancel")
 async def login_cancel(c: CallbackQuery):
-    with contextlib.suppress(Exception):
-        if frag._login_ctx: await frag._login_ctx.close()
-    with contextlib.suppress(Exception):
-        if frag._login_browser: await frag._login_browser.close()
-    frag._login_ctx = None
-    frag._login_browser = None
-    await c.message.answer("Login flow cancelled.", reply_markup=main_menu_kb().as_markup())
+    await frag.cancel_headful_login()
+    await c.message.answer("Login flow cancelled.", reply_markup=main_menu_markup())
     await c.answer()
 
 # ---- Session disconnect ----
 @router.callback_query(F.data == "session:disconnect")
 async def session_disconnect(c: CallbackQuery):
     _, msg = await frag.disconnect()
-    await c.message.answer(f"🔌 {safe_html(msg)}", reply_markup=main_menu_kb().as_markup())
+    await c.message.answer(f"🔌 {safe_html(msg)}", reply_markup=main_menu_markup())
     await c.answer()
 
 # ---- DM: number text ----
-@router.message(F.text)
+@router.message(F.text.regexp(_PHONE_RE))
 async def on_text_number(m: Message):
+    # the filter only lets number-looking text through; normalize still checks length/prefix
     target = normalize_to_888_digits(m.text or "")
     if not target:
         return await m.answer("Send a +888 number like <code>0708 3255</code> or <code>88807083255</code>.")
     await m.answer(f"⏳ Getting code for <b>+{safe_html(target)}</b> …")
     res = await frag.get_code(target)
     if res.code:
-        await m.answer(
-            f"🔑 <b>Code for +{safe_html(res.digits)}</b>: <code>{safe_html(res.code)}</code>\n🔗 {safe_html(res.url)}",
-            reply_markup=code_card_kb(res.digits).as_markup()
-        )
+        text = f"🔑 <b>Code for +{safe_html(res.digits)}</b>: <code>{safe_html(res.code)}</code>\n🔗 {safe_html(res.url)}"
+        sent = await m.answer(text, reply_markup=code_card_kb_markup(res.digits))
+        remember_card(sent, text)
     else:
         msg = "⚠️ No code visible yet" if "browser_not_ready" not in (res.hint or "") else f"⚠️ {safe_html(res.hint)}"
         await m.answer(
             f"{msg} for <b>+{safe_html(res.digits)}</b>.\n"
             f"Open the code page once (button below) after saving a session.\n\n"
             f"🔗 {safe_html(res.url)}",
-            reply_markup=code_card_kb(res.digits).as_markup()
+            reply_markup=code_card_kb_markup(res.digits)
         )
 
 # ---- Callbacks for code card ----
-@router.callback_query(F.data.startswith("code:refresh:"))
-async def cb_refresh(c: CallbackQuery):
-    digits = c.data.split(":")[2]
+@router.callback_query(CodeCB.filter(F.action == "refresh"))
+async def cb_refresh(c: CallbackQuery, callback_data: CodeCB):
+    digits = callback_data.digits
     res = await frag.get_code(digits, force_refresh=True)
     if res.code:
         text = f"🔑 <b>Code for +{safe_html(res.digits)}</b>: <code>{safe_html(res.code)}</code>\n🔗 {safe_html(res.url)}"
@@ -396,13 +896,23 @@ async def cb_refresh(c: CallbackQuery):
             f"Try opening the code page once in your browser.\n\n"
             f"🔗 {safe_html(res.url)}"
         )
-    with contextlib.suppress(Exception):
-        await c.message.edit_text(text, reply_markup=code_card_kb(digits).as_markup())
+    msg = c.message
+    if msg and _shown_cards.get((msg.chat.id, msg.message_id)) == text:
+        return await c.answer("No change.")  # skip Telegram's "message is not modified" round-trip
+    try:
+        await msg.edit_text(text, reply_markup=code_card_kb_markup(digits))
+        remember_card(msg, text)
+    except TelegramBadRequest as e:
+        # card already shows this text (e.g. sent before a restart): remember it for next time
+        if "message is not modified" in str(e):
+            remember_card(msg, text)
+    except Exception:
+        pass
     await c.answer("Updated.")
 
-@router.callback_query(F.data.startswith("code:digits:"))
-async def cb_digits(c: CallbackQuery):
-    digits = c.data.split(":")[2]
+@router.callback_query(CodeCB.filter(F.action == "digits"))
+async def cb_digits(c: CallbackQuery, callback_data: CodeCB):
+    digits = callback_data.digits
     await c.message.answer(f"📋 Digits: <code>{safe_html(digits)}</code>")
     await c.answer()
 
@@ -428,39 +938,61 @@ async def on_inline(iq: InlineQuery):
             is_personal=True
         )
 
-    res = await frag.get_code(digits)
-    title = f"+{digits} • Login code" if res.code else f"+{digits} • Open code page"
+    # answer from cache only; on a miss, warm the cache in the background for the next keystroke
+    code = frag.peek_cache(digits)
+    if not code:
+        spawn(frag.get_code(digits))
+    url = fragment_links(digits)[1]
+    title = f"+{digits} • Login code" if code else f"Fetching code for +{digits}…"
     text = (
-        f"🔑 Code for +{safe_html(digits)}: <code>{safe_html(res.code)}</code>\n🔗 {safe_html(res.url)}"
-        if res.code else
-        f"🔗 Open code page for +{safe_html(digits)}:\n{safe_html(res.url)}"
+        f"🔑 Code for +{safe_html(digits)}: <code>{safe_html(code)}</code>\n🔗 {safe_html(url)}"
+        if code else
+        f"🔗 Open code page for +{safe_html(digits)}:\n{safe_html(url)}"
     )
-    kb = code_card_kb(digits).as_markup()
+    kb = code_card_kb_markup(digits)
     await iq.answer(
         results=[
             InlineQueryResultArticle(
-                id=f"otp-{digits}",
+                id=f"otp-{digits}" if code else f"open-{digits}",
                 title=title,
                 input_message_content=InputTextMessageContent(text, parse_mode="HTML"),
-                description="Live OTP fetched" if res.code else "Tap to open the code page",
-                url=res.url,
+                description="Live OTP fetched" if code else "Type a space in a moment to see it, or tap to open the code page",
+                url=url,
                 reply_markup=kb
             )
         ],
-        cache_time=1,
+        cache_time=1 if code else 0,
         is_personal=True
     )
 
 # ================ Runner ========================
 async def main():
     await frag.start()
+    spawn(frag.warmup())  # first user request finds Chromium already running
     bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
     dp = Dispatcher()
     dp.include_router(router)
     print("Bot online. Enable Inline in @BotFather to use inline queries.")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)  # closes the bot session itself on exit
+    finally:
+        await frag.stop()
+
+def install_uvloop():
+    """
+    Use uvloop's event loop when it's installed; the stdlib loop otherwise.
+    Set USE_UVLOOP=0 to opt out (older uvloop + Playwright subprocess pipes could crash).
+    """
+    if os.getenv("USE_UVLOOP", "1") != "1":
+        return
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
 
 if __name__ == "__main__":
+    install_uvloop()
     try:
         asyncio.run(main())
     except Exception: